@@ -1,7 +1,13 @@
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 
 import pytest
 
+from tritoolkit import _utils, geography
+from tritoolkit.api import TriApiClient, Table, core
+
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -40,3 +46,89 @@ def vcr_config():
         "record_mode": "once",
         "match_on": ["uri", "method"],
     }
+
+
+@pytest.fixture(scope="session")
+def tri_client() -> TriApiClient:
+    return TriApiClient()
+
+
+@pytest.fixture(scope="session")
+def table(request) -> Table:
+    # parametrize indirectly with the table name; one Table (and one session
+    # and row count) is shared by every test that asks for the same table
+    return Table(request.param)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path: Path, monkeypatch) -> Path:
+    # point the row count and geocode caches at an empty per-test directory, so tests
+    # neither read nor fill the real ones in ~/.cache/tritoolkit
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("TRITOOLKIT_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(_utils, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(core, "CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(core, "_memory", None)
+    monkeypatch.setattr(geography, "GEOCODE_CACHE", str(cache_dir / "geocache.sqlite"))
+    return cache_dir
+
+
+class FakeGeocoder:
+    """
+    Stand-in for `geography.geocode_from_raw_address()` that looks exact address
+    strings up in `locations` and records every address it is asked for in `calls`
+    """
+
+    def __init__(self):
+        self.locations = {}
+        self.calls = []
+
+    def __call__(self, address_string, geolocator_obj):
+        self.calls.append(address_string)
+        return self.locations.get(address_string)
+
+
+@pytest.fixture
+def fake_geocoder(monkeypatch) -> FakeGeocoder:
+    geocoder = FakeGeocoder()
+    monkeypatch.setattr(geography, "geocode_from_raw_address", geocoder)
+    return geocoder
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Base request handler for the local stub servers started by `stub_server`.
+    Subclasses implement do_GET/do_POST and reply with `_send()`
+    """
+
+    content_type = "application/json"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body: bytes, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", self.content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def stub_server():
+    # start(handler) serves handler on a free localhost port in a background thread.
+    # server.requests is a Counter for the handler to count requests with
+    servers = []
+
+    def start(handler) -> ThreadingHTTPServer:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.requests = Counter()
+        server.url = f"http://127.0.0.1:{server.server_address[1]}"
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,44 @@
+"""
+Internal helpers shared by the api and geography modules
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+
+# on-disk cache for results that rarely change, e.g. table row counts and geocoded
+# addresses. Delete this directory to refresh them.
+CACHE_DIR = os.environ.get(
+    "TRITOOLKIT_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "tritoolkit"),
+)
+
+
+def is_transient_status(status: int) -> bool:
+    # rate limited or a server-side error, either of which may clear up on retry
+    return status == 429 or status >= 500
+
+
+def backoff_delay(
+    attempt: int, base_delay: float = 1.0, max_delay: float = 30.0, jitter: float = 0.5
+) -> float:
+    """
+    Seconds to wait before retry number ``attempt`` (counting from 0): exponential
+    backoff capped at ``max_delay``, stretched by up to ``jitter`` at random so that
+    concurrent requests do not retry in lockstep.
+    """
+    delay = min(base_delay * (2**attempt), max_delay)
+    return delay * (1 + random.uniform(0, jitter))
+
+
+def run_async(coro):
+    """
+    Run a coroutine to completion. If an event loop is already running in this
+    thread (e.g. in a Jupyter notebook), run it on a fresh loop in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
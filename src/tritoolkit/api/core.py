@@ -1,15 +1,30 @@
-from io import StringIO
-from functools import wraps
-from typing import Optional, Union, Dict, List
+import asyncio
+from datetime import date
+from io import BytesIO
+from functools import cached_property, wraps
+from typing import IO, Optional, Union, Dict, List, Tuple
+import re
+import time
+from urllib.parse import quote
 import warnings
 
+import aiohttp
 import pandas as pd
 import requests
+from joblib import Memory
+from requests.adapters import HTTPAdapter
 from requests.models import Response
-from joblib import Parallel, delayed
+from requests.utils import get_encoding_from_headers
 from tqdm import tqdm
 
+try:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+except ImportError:
+    pa = None
+
 from ..__version__ import __version__
+from .._utils import CACHE_DIR, backoff_delay, is_transient_status, run_async
 from .exceptions import (
     TransientTriApiException,
     TriApiError,
@@ -19,27 +34,69 @@ from .exceptions import (
 def retry_on_transient_error(func):
     """
     Retry a request up to self.num_retries times. If it exits with a
-    ``TransientIpumsApiException``, then retry, else just immediately ``raise``
+    ``TransientTriApiException``, then back off and retry, else just immediately
+    ``raise``. Works on both regular and ``async`` methods.
     """
 
+    if asyncio.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapped_func(self, *args, **kwargs):
+            for attempt in range(self.num_retries - 1):
+                try:
+                    return await func(self, *args, **kwargs)
+                except TransientTriApiException:
+                    await asyncio.sleep(backoff_delay(attempt))
+            return await func(self, *args, **kwargs)
+
+        return async_wrapped_func
+
     @wraps(func)
     def wrapped_func(self, *args, **kwargs):
-        for _ in range(self.num_retries - 1):
+        for attempt in range(self.num_retries - 1):
             try:
                 return func(self, *args, **kwargs)
             except TransientTriApiException:
-                pass
+                time.sleep(backoff_delay(attempt))
         return func(self, *args, **kwargs)
 
     return wrapped_func
 
 
+# headers for requests that return table data
+CSV_HEADERS = {"Accept": "text/csv"}
+
+# joblib cache in CACHE_DIR, see _get_memory()
+_memory: Optional[Memory] = None
+
+
+def _get_memory() -> Memory:
+    # created on first use rather than at import, so that importing tritoolkit
+    # never touches the filesystem. If the cache directory can't be created
+    # (e.g. a read-only home directory), results just aren't cached
+    global _memory
+    if _memory is None:
+        try:
+            _memory = Memory(location=CACHE_DIR, verbose=0)
+        except OSError:
+            _memory = Memory(location=None, verbose=0)
+    return _memory
+
+
+def _fetch_count(table_url: str, client: "TriApiClient", day: str) -> int:
+    # day is only part of the cache key, so that cached counts expire daily as the
+    # tables grow
+    count = client.get(f"{table_url}/COUNT/JSON")
+    return count.json()[0]["TOTALQUERYRESULTS"]
+
+
 class TriApiClient:
     def __init__(
         self,
         num_retries: int = 3,
         session: Optional[requests.Session] = None,
         base_url: Optional[str] = "https://data.epa.gov/efservice",
+        max_connections: int = 32,
     ):
         """
         Class for retrieving TRI data via API
@@ -47,13 +104,29 @@ class TriApiClient:
         Args:
             num_retries: number of times a request will be retried before
                         raising `TransientTriApiException`
-            session: requests session object
+            session: requests session object. If not given, a session with a
+                     pooled, keep-alive connection adapter is created. The chunk
+                     downloads in `Table.all_rows()` go through a separate aiohttp
+                     session, which doesn't use this one, but does pick up proxy
+                     settings from the environment (HTTP(S)_PROXY, NO_PROXY, .netrc)
             base_url: Envirofacts TRI url
+            max_connections: maximum number of requests in flight at once when
+                        downloading table chunks concurrently
 
         """
         self.num_retries = num_retries
         self.base_url = base_url
-        self.session = session or requests.session()
+        if session is None:
+            session = requests.session()
+            # reuse connections to the TRI host rather than re-handshaking per request
+            adapter = HTTPAdapter(pool_connections=64, pool_maxsize=64, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers["Connection"] = "keep-alive"
+        self.session = session
+        # connection settings for the aiohttp session used for concurrent requests
+        self.connection_limit = max_connections
+        self.keepalive_timeout = 30
 
     @retry_on_transient_error
     def request(self, method: str, *args, **kwargs) -> requests.Response:
@@ -64,58 +137,152 @@ class TriApiClient:
             response = self.session.request(method, *args, **kwargs)
             response.raise_for_status()
             return response
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as err:
+            raise TransientTriApiException(f"A transient error occured: {err}")
         except requests.exceptions.HTTPError as http_err:
+            if is_transient_status(http_err.response.status_code):
+                raise TransientTriApiException(f"A transient error occured: {http_err}")
             raise TriApiError(f"An error occured: {http_err}")
 
     def get(self, *args, **kwargs) -> requests.Response:
         """GET a request from the TRI API"""
         return self.request("get", *args, **kwargs)
 
+    def async_session(self) -> aiohttp.ClientSession:
+        """
+        Create an aiohttp session with a pooled, keep-alive connector. aiohttp
+        sessions are bound to the event loop they are created in, so a new one is
+        created for each batch of concurrent requests. Like requests, it uses the
+        proxy settings from the environment.
+        """
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit, keepalive_timeout=self.keepalive_timeout
+        )
+        return aiohttp.ClientSession(connector=connector, trust_env=True)
+
 
 class Table(TriApiClient):
     def __init__(
         self,
         name: str = None,
+        csv_engine: str = "c",
+        max_connections: int = 32,
+        use_cache: bool = True,
     ):
         """
         Class for retrieving and filtering TRI database tables via API
 
         Args:
             name: The name of a table in the TRI database
+            csv_engine: Parser used for API responses. Either "c" (the pandas
+                        default) or "pyarrow", which is multithreaded and faster
+                        on large tables. With "pyarrow", returned data frames have
+                        arrow-backed columns (`pd.ArrowDtype`) with types inferred
+                        by Arrow (e.g. ISO dates become timestamps). Requires
+                        pyarrow, otherwise an ImportError is raised.
+            max_connections: maximum number of chunk requests `all_rows()` keeps
+                        in flight at once
+            use_cache: if False, the row count is fetched from the API even if
+                        it was cached today, and replaces the cached count
         """
-        super().__init__()
+        super().__init__(max_connections=max_connections)
+        if csv_engine == "pyarrow" and pa is None:
+            raise ImportError(
+                'csv_engine="pyarrow" requires pyarrow. Install it with the '
+                "tritoolkit[arrow] extra, or use the default c engine"
+            )
+        self.csv_engine = csv_engine
+        self.use_cache = use_cache
         self.name = name
         self.table_url = f"{self.base_url}/{self.name.upper()}"
-        self.rows = self._get_rows()
-        self.segments = list(
-            self._divide_rows_into_chunks(range(0, self.rows + 1), 10000)
-        )
+
+    @cached_property
+    def rows(self) -> int:
+        """
+        Number of rows in the table, fetched from the API on first use and cached
+        on disk in `CACHE_DIR` for the rest of the day
+        """
+        return self._get_rows()
+
+    @cached_property
+    def segments(self) -> List[Tuple[int, int]]:
+        """First and last row of each chunk of up to 10000 rows in the table"""
+        return self._segments(self.rows)
 
     def _get_rows(self) -> int:
-        count = self.session.get(f"{self.table_url}/COUNT/JSON")
-        total_rows = count.json()[0]["TOTALQUERYRESULTS"]
-        return total_rows
+        # cached on disk, so repeat runs on the same day don't ask the API again
+        memory = _get_memory()
+        fetch_count = memory.cache(_fetch_count, ignore=["client"])
+        day = date.today().isoformat()
+        if not self.use_cache and memory.location is not None:
+            # fetch the count and overwrite the cached one
+            count, _ = fetch_count.call(self.table_url, self, day)
+            return count
+        return fetch_count(self.table_url, self, day)
 
-    def _divide_rows_into_chunks(self, l: List, n: int):
-        # looping till length l
-        for i in range(0, len(l), n):
-            l2 = l[i : i + n]
-            yield (l2[0], l2[-1])
+    def _segments(self, total: int, n: int = 10000) -> List[Tuple[int, int]]:
+        # (first, last) row of each chunk of n rows in 0..total
+        return [(i, min(i + n - 1, total)) for i in range(0, total + 1, n)]
 
     # In theory I should be able to do all of this with json returns,
     # but the /JSON option is causing internal server errors and I don't know why,
     # but CSV is working so I am rolling with that for now.
-    def _csv_string_to_df(self, csv_string: str) -> pd.DataFrame:
-        # get the header
-        csv_list = csv_string.split("\n")
-        header = csv_list[0].split(",")
-        # make it a table
-        table_data = StringIO(csv_string)
+    def _read_csv(
+        self, csv_data: Union[IO, str], encoding: Optional[str] = None
+    ) -> pd.DataFrame:
+        if self.csv_engine == "pyarrow":
+            return self._read_csv_arrow(csv_data, encoding).to_pandas(
+                types_mapper=pd.ArrowDtype
+            )
         # skip bad lines for now
         # TODO: incorporate database schema info to be able to specify
         # column names and retain bad/incomplete lines. Test on Forms
-        table_df = pd.read_csv(table_data, sep=",", names=header, skiprows=1, on_bad_lines="skip")
-        return table_df
+        try:
+            return pd.read_csv(
+                csv_data, sep=",", encoding=encoding, on_bad_lines="skip"
+            )
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+
+    def _read_csv_arrow(
+        self, csv_data: Union[IO, str], encoding: Optional[str] = None
+    ) -> "pa.Table":
+        # skip bad lines, same as the c engine
+        try:
+            return pa_csv.read_csv(
+                csv_data,
+                read_options=pa_csv.ReadOptions(encoding=encoding or "utf8"),
+                parse_options=pa_csv.ParseOptions(invalid_row_handler=lambda _: "skip"),
+            )
+        except pa.ArrowInvalid as err:
+            # nothing to parse, not even a header
+            if "Empty CSV file" in str(err):
+                return pa.table({})
+            raise
+
+    def _get_csv(self, url: str) -> pd.DataFrame:
+        # stream the response body straight into the parser
+        # rather than decoding the whole thing to a string first
+        response = self.get(url, headers=CSV_HEADERS, stream=True)
+        response.raw.decode_content = True
+        with response:
+            return self._read_csv(response.raw, encoding=response.encoding)
+
+    def _row_range_url(self, row_min: str, row_max: str, url: str = None) -> str:
+        # if url not specified, default standard table url
+        if url is None:
+            return f"{self.table_url}/rows/{row_min}:{row_max}/CSV/"
+        # if url ends with CSV, chop that off
+        url_list = url.split("/")
+        if url_list[-1] == "CSV":
+            # add in the row bits
+            url_list[-1] = f"rows/{row_min}:{row_max}/CSV/"
+        else:
+            url_list.append(f"rows/{row_min}:{row_max}/CSV/")
+        return "/".join(url_list)
 
     def get_row_range(self, row_min: str, row_max: str, url: str = None):
         """
@@ -128,24 +295,53 @@ class Table(TriApiClient):
 
         Returns: A pandas data frame with the requested table rows
         """
-        # if url not specified, default standard table url
-        if url is None:
-            _url = f"{self.table_url}/rows/{row_min}:{row_max}/CSV/"
-        else:
-            # if url ends with CSV, chop that off
-            url_list = url.split("/")
-            if url_list[-1] == "CSV":
-                # add in the row bits
-                url_list[-1] = f"rows/{row_min}:{row_max}/CSV/"
-            else:
-                url_list.append(f"rows/{row_min}:{row_max}/CSV/")
-            _url = "/".join(url_list)
-        # get table section
-        csv_str = self.session.get(f"{_url}")
-        # csv_str.raise_for_status()
-        # put it into a data frame
-        table_df = self._csv_string_to_df(csv_str.text)
-        return table_df
+        # get table section as a data frame
+        return self._get_csv(self._row_range_url(row_min, row_max, url))
+
+    @retry_on_transient_error
+    async def _get_row_range_async(
+        self,
+        session: aiohttp.ClientSession,
+        row_min: str,
+        row_max: str,
+        url: str = None,
+    ) -> Tuple[bytes, Optional[str]]:
+        try:
+            async with session.get(
+                self._row_range_url(row_min, row_max, url), headers=CSV_HEADERS
+            ) as response:
+                response.raise_for_status()
+                # leave decoding to the csv parser, using the same
+                # encoding rules requests applies to the other calls
+                encoding = get_encoding_from_headers(response.headers)
+                return await response.read(), encoding
+        except (
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+        ) as err:
+            # a truncated response body is a ClientPayloadError
+            raise TransientTriApiException(f"A transient error occured: {err}")
+        except aiohttp.ClientResponseError as http_err:
+            if is_transient_status(http_err.status):
+                raise TransientTriApiException(f"A transient error occured: {http_err}")
+            raise TriApiError(f"An error occured: {http_err}")
+
+    async def _get_all_row_ranges_async(
+        self, url: str = None
+    ) -> List[Tuple[bytes, Optional[str]]]:
+        async with self.async_session() as session:
+            tasks = [
+                asyncio.ensure_future(
+                    self._get_row_range_async(session, str(seg[0]), str(seg[1]), url)
+                )
+                for seg in self.segments
+            ]
+            with tqdm(total=len(tasks)) as progress:
+                for task in tasks:
+                    task.add_done_callback(lambda _: progress.update())
+                # if any chunk fails, the rest are cancelled when the loop shuts down
+                return await asyncio.gather(*tasks)
 
     def all_rows(self, url: Optional[str] = None) -> pd.DataFrame:
         """
@@ -159,32 +355,52 @@ class Table(TriApiClient):
         if self.rows < 10001:
             df = self.get_row_range(0, self.rows, url)
         else:
-            # use all but 2 cpu
-            df_segments = Parallel(n_jobs=-3)(
-                delayed(self.get_row_range)(str(i[0]), str(i[1]), url)
-                for i in tqdm(self.segments)
-            )
-            df = pd.concat(df_segments, ignore_index=True)
+            # fetch all chunks concurrently over a single event loop,
+            # then parse them here once they have all arrived
+            csv_chunks = run_async(self._get_all_row_ranges_async(url))
+            if self.csv_engine == "pyarrow":
+                df = self._concat_arrow_chunks(csv_chunks)
+            else:
+                df_segments = [
+                    self._read_csv(BytesIO(csv_bytes), encoding)
+                    for csv_bytes, encoding in csv_chunks
+                ]
+                df = pd.concat(df_segments, ignore_index=True, copy=False)
         return df
 
+    def _concat_arrow_chunks(
+        self, csv_chunks: List[Tuple[bytes, Optional[str]]]
+    ) -> pd.DataFrame:
+        tables = [
+            self._read_csv_arrow(BytesIO(csv_bytes), encoding)
+            for csv_bytes, encoding in csv_chunks
+        ]
+        try:
+            # join the column buffers as they are, then convert to pandas once,
+            # keeping the columns arrow-backed
+            table = pa.concat_tables(tables)
+        except pa.ArrowInvalid:
+            # chunks were inferred with different column types
+            return pd.concat(
+                [t.to_pandas(types_mapper=pd.ArrowDtype) for t in tables],
+                ignore_index=True,
+                copy=False,
+            )
+        return table.to_pandas(types_mapper=pd.ArrowDtype)
+
     def _fix_filter_strings(self, filter_value: str) -> str:
-        # hack to handle operators
-        if filter_value[0] == "<":
-            filter_value.replace("<", "/")
-            filter_value = f"<{filter_value}"
-        elif filter_value[0] == ">":
-            print("...should be here")
-            filter_value = filter_value.replace(">", "/")
-            filter_value = f">{filter_value}"
-            print("fixed value", filter_value)
-        elif filter_value[:1] == "!=":
-            filter_value.replace("!=", "/")
-            filter_value = f"!={filter_value}"
-        # replace spaces with %20
-        fixed_filter_value = filter_value.replace(" ", "%20")
-        # replace dashes with %2D
-        fixed_filter_value = fixed_filter_value.replace("-", "%2D")
-        return fixed_filter_value
+        # comparison operators go in their own path segment ahead of the value,
+        # e.g. ">2015" -> ">/2015"
+        for operator in ("!=", "<", ">"):
+            if filter_value.startswith(operator):
+                value = self._fix_filter_strings(filter_value[len(operator) :])
+                return f"{operator}/{value}"
+        # percent-encode anything that isn't url safe. Existing escapes such as
+        # "%20" pass through unchanged, so already encoded values still work, while
+        # any other "%" is encoded ("50%" -> "50%25"). Dashes are sent as "%2D"
+        filter_value = quote(filter_value, safe="%")
+        filter_value = re.sub(r"%(?![0-9A-Fa-f]{2})", "%25", filter_value)
+        return filter_value.replace("-", "%2D")
 
     def filter(self, filters: Dict[str, Union[str, List[str]]] = {}) -> pd.DataFrame:
         """
@@ -198,30 +414,33 @@ class Table(TriApiClient):
 
         Returns: A pandas data frame of the filtered rows
         """
+        # table column names are upper case
+        filters = {col.upper(): value for col, value in filters.items()}
         # split filters into strings and lists
-        single_filters = [f for f in filters.keys() if isinstance(filters[f], str)]
-        list_filters = [f for f in filters.keys() if isinstance(filters[f], list)]
-        # first assemble url based on single filters
-        updated_url = [self.table_url]
-        # TODO: better error handling for non-existant columns
-        for col in single_filters:
-            # fix strings for url
-            filter_value = self._fix_filter_strings(filters[col.upper()])
-            updated_url.append(f"{col.upper()}/{str(filter_value)}")
-        updated_url.append("CSV")
-        filtered_url = "/".join(updated_url)
-        csv_str = self.session.get(filtered_url).text
-        table_df = self._csv_string_to_df(csv_str)
-        # if the table has exactly 10001 records, that means that
-        # the request maxed out the number of rows that could be requested
-        # in this case, we'll grab and filter the whole table...
-        # Same deal if the first return is empty (i.e. only list type filters
-        # were specified and none of those values were found in the first return)
-        # This also falls down if bad rows are dropped when the serialized csv is
-        # converted to a data frame...the request is maxed out, but fewer than 10001
-        # rows in the df...
-        if len(table_df.index) == 10001 or len(table_df.index) == 0:
-            table_df = self.all_rows(filtered_url)
+        single_filters = [col for col, val in filters.items() if isinstance(val, str)]
+        list_filters = [col for col, val in filters.items() if isinstance(val, list)]
+        if not single_filters:
+            # without any single-value filters the first request would just be
+            # the first 10001 rows of the table, so go straight to the whole table
+            table_df = self.all_rows()
+        else:
+            # first assemble url based on single filters, with values fixed for url
+            # TODO: better error handling for non-existant columns
+            filter_path = "/".join(
+                f"{col}/{self._fix_filter_strings(filters[col])}"
+                for col in single_filters
+            )
+            filtered_url = f"{self.table_url}/{filter_path}/CSV"
+            table_df = self._get_csv(filtered_url)
+            # if the table has exactly 10001 records, that means that
+            # the request maxed out the number of rows that could be requested
+            # in this case, we'll grab and filter the whole table...
+            # Same deal if the first return is empty
+            # This also falls down if bad rows are dropped when the serialized csv is
+            # converted to a data frame...the request is maxed out, but fewer than
+            # 10001 rows in the df...
+            if len(table_df.index) == 10001 or len(table_df.index) == 0:
+                table_df = self.all_rows(filtered_url)
         # once we're sure we have all rows required from the single-value filters
         # filter the resulting data frame based on the list filters
         for col in list_filters:
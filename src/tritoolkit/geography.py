@@ -1,12 +1,61 @@
-from typing import Any, Optional, Dict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
+from functools import lru_cache
+from typing import Any, Optional, Dict, List, Tuple, Union
+import asyncio
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
 import warnings
+import weakref
 
+import aiohttp
 import pandas as pd
 import numpy as np
 import geopandas as gpd
+import requests
+import shapely
 from geopy.extra.rate_limiter import RateLimiter
 from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderUnavailable
+from geopy.exc import GeocoderServiceError, GeocoderUnavailable
+from pyproj import CRS, Transformer
+
+from ._utils import CACHE_DIR, backoff_delay, is_transient_status, run_async
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+ARCGIS_BATCH_URL = (
+    "https://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer"
+    "/geocodeAddresses"
+)
+GEOCODE_CACHE = os.path.join(CACHE_DIR, "geocache.sqlite")
+# street address suffixes dropped on the last geocoding attempt
+_CARDINALS = frozenset({"NE", "SE", "NW", "SW"})
+# columns passed to geocoder_wrapper(), in address order
+ADDRESS_FIELDS = [
+    "STREET_ADDRESS",
+    "CITY_NAME",
+    "COUNTY_NAME",
+    "STATE_ABBR",
+    "ZIP_CODE",
+]
+_RATE_LIMITERS: "weakref.WeakKeyDictionary[Nominatim, RateLimiter]" = (
+    weakref.WeakKeyDictionary()
+)
+_RATE_LIMITERS_LOCK = threading.Lock()
+# default geolocator, shared so the connection pool and the delay between requests
+# carry over between calls
+_GEOLOCATOR = Nominatim(user_agent="tritoolkit", timeout=10)
+_HOST_SEMAPHORES: Dict[str, threading.Semaphore] = {}
+_HOST_SEMAPHORES_LOCK = threading.Lock()
 
 # TODO
 # [] validation for lat and lon fields
@@ -22,43 +71,90 @@ class RetriesExhaustedWarning(Warning):
     pass
 
 
-def dms_to_dd(dms_value: Any) -> float:
+def _dms_int_to_dd(dms_int: int) -> float:
+    # up to 3 digits for degrees, 2 for minutes, 2 for seconds
+    degrees, remainder = divmod(abs(dms_int), 10000)
+    minutes, seconds = divmod(remainder, 100)
+    return math.copysign(degrees + (minutes / 60) + (seconds / 3600), dms_int)
+
+
+if numba is not None:
+    # compile the conversion to native code when numba is available.
+    # fastmath is left off so results match the pure python version exactly
+    _dms_int_to_dd = numba.njit(cache=True)(_dms_int_to_dd)
+
+
+@lru_cache(maxsize=None)
+def _dms_ufunc():
+    # parallel ufunc over int64 arrays, compiled on first use
+    return numba.vectorize(["float64(int64)"], target="parallel")(_dms_int_to_dd)
+
+
+def _dms_array_to_dd(dms_values: np.ndarray) -> np.ndarray:
+    # vectorized conversion of an array of DDDMMSS values, NaN for missing values
+    dms_values = np.asarray(dms_values, dtype="float64")
+    missing = np.isnan(dms_values)
+    dms_ints = np.where(missing, 0, dms_values).astype("int64")
+    if numba is not None:
+        dd_values = _dms_ufunc()(dms_ints)
+        dd_values[missing] = np.nan
+        return dd_values
+    sign = np.where(dms_ints < 0, -1, 1)
+    dms_ints = np.abs(dms_ints)
+    # up to 3 digits for degrees, 2 for minutes, 2 for seconds
+    degrees = dms_ints // 10000
+    minutes = (dms_ints // 100) % 100
+    seconds = dms_ints % 100
+    dd_values = sign * (degrees + (minutes / 60) + (seconds / 3600))
+    dd_values[missing] = np.nan
+    return dd_values
+
+
+def dms_to_dd(dms_value: Any) -> Union[float, np.ndarray, pd.Series]:
     """
     Utility function to convert degrees minutes seconds coordinates to decimal degrees.
 
     Args:
-        dms_value: A degrees-minutes-seconds location value.
+        dms_value: A degrees-minutes-seconds location value. A NumPy array or
+                   pandas Series of values is converted all at once.
 
-    Returns: The same value in decimal degrees.
+    Returns: The same value(s) in decimal degrees.
     """
+    if isinstance(dms_value, pd.Series):
+        return dms_to_dd_series(dms_value)
+    if isinstance(dms_value, np.ndarray):
+        return _dms_array_to_dd(dms_value)
 
     # if the dms_value passed is nan, return nan
     try:
-        # convert decimal degree value to string value
-        if not isinstance(dms_value, str):
-            dms_value = str(int(dms_value))
+        dms_int = int(float(dms_value))
     except ValueError:
         return np.nan
-    # maximum string length is 8
-    # 1 for the -, 3 for d, 2 for m, 2 for s
-    if len(dms_value) < 8:
-        dms_value = dms_value.zfill(8)
-    if "-" in dms_value:
-        dms_value = dms_value.replace("-", "0")
-        degrees = int(dms_value[:4])
-        minutes = int(dms_value[4:6])
-        seconds = int(dms_value[-2:])
-        dd_value = -(degrees + (minutes / 60) + (seconds / 3600))
-    else:
-        degrees = int(dms_value[:4])
-        minutes = int(dms_value[4:6])
-        seconds = int(dms_value[-2:])
-        dd_value = degrees + (minutes / 60) + (seconds / 3600)
-    return dd_value
+    return _dms_int_to_dd(dms_int)
+
+
+def dms_to_dd_series(dms_values: pd.Series) -> pd.Series:
+    """
+    Vectorized version of `dms_to_dd()` that converts a whole column of
+    degrees-minutes-seconds coordinates to decimal degrees at once.
+
+    Args:
+        dms_values: A series of degrees-minutes-seconds location values.
+
+    Returns: A float series of the same values in decimal degrees. Missing values are NaN.
+    """
+    dd_values = _dms_array_to_dd(
+        pd.to_numeric(dms_values).to_numpy(dtype="float64", na_value=np.nan)
+    )
+    return pd.Series(dd_values, index=dms_values.index, name=dms_values.name)
 
 
 def to_geopandas_df(
-    df: pd.DataFrame, lat_field: str, lon_field: str, dropna: bool = True
+    df: pd.DataFrame,
+    lat_field: str,
+    lon_field: str,
+    dropna: bool = True,
+    dms: bool = False,
 ):
     """
     Convert pandas data frame to geopandas data frame
@@ -68,29 +164,123 @@ def to_geopandas_df(
         lat_field: Name of the column containing Latitude in df
         lon_field: Name of the column containing Longitude in df
         dropna: drop rows with missing lat or lon values. Default is True
+        dms: lat_field and lon_field hold degrees-minutes-seconds values, which are
+             converted to decimal degrees to build the geometry. Default is False
 
     Returns:
         A geopandas data frame using lat_field and lon_field to generate geometry
     """
     # TODO: validation of contents of lat and lon field to make sure they are plausibly lat/lon values
     if dropna:
-        missing_lat = len(df[(df[lat_field].isna() == True)])
-        missing_lon = len(df[(df[lon_field].isna() == True)])
-        df = df[(df[lat_field].isna() == False) & (df[lon_field].isna() == False)]
-        warnings.warn(
-            f"{missing_lat} missing values in {lat_field} and {missing_lon} missing values in {lon_field}. These rows will be dropped",
-            MissingCoordinatesWarning,
-        )
+        lat_na = df[lat_field].isna()
+        lon_na = df[lon_field].isna()
+        missing_lat = int(lat_na.sum())
+        missing_lon = int(lon_na.sum())
+        df = df.loc[~(lat_na | lon_na)]
+        if missing_lat or missing_lon:
+            warnings.warn(
+                f"{missing_lat} missing values in {lat_field} and {missing_lon} missing values in {lon_field}. These rows will be dropped",
+                MissingCoordinatesWarning,
+            )
 
+    lats = df[lat_field].to_numpy()
+    lons = df[lon_field].to_numpy()
+    if dms:
+        lats = dms_to_dd(lats.astype("float64"))
+        lons = dms_to_dd(lons.astype("float64"))
+    # build the points from the raw coordinate arrays, with the crs set up front.
+    # After dropna, df is already a new frame, so there is no need to copy it again
     gdf = gpd.GeoDataFrame(
-        df, geometry=gpd.points_from_xy(df[lon_field], df[lat_field])
+        df,
+        geometry=gpd.points_from_xy(lons, lats, crs="EPSG:4326"),
+        copy=not dropna,
     )
-
-    # set crs
-    gdf.set_crs(epsg=4326, inplace=True)
     return gdf
 
 
+def _read_file(shape_file: str) -> gpd.GeoDataFrame:
+    # pyogrio reads the whole layer through GDAL's columnar API instead of building
+    # a python object for every feature like fiona does
+    return gpd.read_file(shape_file, engine="pyogrio")
+
+
+@lru_cache(maxsize=8)
+def _load_polygons(shape_file: str, mtime: float) -> gpd.GeoDataFrame:
+    # mtime is only part of the cache key, so an edited file is read again
+    polygons = _read_file(shape_file)
+    # build the spatial index now so it is cached along with the polygons
+    polygons.sindex
+    return polygons
+
+
+def _read_polygons(shape_file: str) -> gpd.GeoDataFrame:
+    # the returned frame is shared between calls, so it must not be modified
+    try:
+        mtime = os.path.getmtime(shape_file)
+    except OSError:
+        # not a local file (e.g. a url), so don't cache it
+        return _read_file(shape_file)
+    return _load_polygons(os.fspath(shape_file), mtime)
+
+
+def _reproject_xy(xy: np.ndarray, from_crs, to_crs) -> np.ndarray:
+    # reproject an (n, 2) array of coordinates with a single PROJ call
+    transformer = Transformer.from_crs(from_crs, to_crs, always_xy=True)
+    return np.column_stack(transformer.transform(xy[:, 0], xy[:, 1]))
+
+
+def points_in_polygons(
+    points_gdf: gpd.GeoDataFrame, polys_gdf: gpd.GeoDataFrame
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Find the points that fall inside each polygon. Both data frames must use the
+    same crs, and points_gdf must only contain point geometry.
+
+    Args:
+        points_gdf: A geopandas data frame of points
+        polys_gdf: A geopandas data frame of polygons
+
+    Returns: Two arrays of positional indices, of the polygons and of the points they
+             contain
+    """
+    return _points_in_polygons(
+        np.asarray(points_gdf.geometry.values), np.asarray(polys_gdf.geometry.values)
+    )
+
+
+def _points_in_polygons(
+    points: np.ndarray,
+    polygons: np.ndarray,
+    from_crs=None,
+    to_crs=None,
+    polygon_index=None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # coordinates of the points that have any, reprojected from from_crs to to_crs
+    # if they differ
+    positions = np.flatnonzero(~(shapely.is_missing(points) | shapely.is_empty(points)))
+    xy = shapely.get_coordinates(points[positions])
+    if from_crs == to_crs:
+        points = points[positions]
+    else:
+        xy = _reproject_xy(xy, from_crs, to_crs)
+        points = shapely.points(xy)
+    # with an existing spatial index of the polygons, drop the ones that are nowhere
+    # near the points first (e.g. a national layer joined with one state's points)
+    poly_positions = np.arange(len(polygons))
+    if polygon_index is not None and len(xy):
+        bounds = shapely.box(*xy.min(axis=0), *xy.max(axis=0))
+        poly_positions = np.sort(polygon_index.query(bounds))
+        polygons = polygons[poly_positions]
+    # candidate pairs from the polygon bounding boxes, then a single vectorized
+    # point-in-polygon test on the raw coordinates of all candidates
+    poly_idx, point_idx = shapely.STRtree(points).query(shapely.envelope(polygons))
+    shapely.prepare(polygons)
+    contained = shapely.contains_xy(
+        polygons[poly_idx], xy[point_idx, 0], xy[point_idx, 1]
+    )
+    return poly_positions[poly_idx[contained]], positions[point_idx[contained]]
+
+
 def tri_points_to_polygons(gdf: gpd.GeoDataFrame, shape_file: str) -> gpd.GeoDataFrame:
     """
     A convenience method to perform a spatial join of TRI lat/lon point geometries
@@ -102,17 +292,76 @@ def tri_points_to_polygons(gdf: gpd.GeoDataFrame, shape_file: str) -> gpd.GeoDat
 
     Returns: a geopandas GeoDataFrame with polygon geometry for polygons in the shape_file containing TRI points
     """
-    polygons = gpd.read_file(shape_file)
-    # if gdf crs is not defined, assume these are manual lat/lon, and assign WSG4
-    if gdf.crs is None:
-        gdf = gdf.set_crs(epsg=4326)
-    # set crs of point gdf to match the polygons
-    gdf = gdf.to_crs(polygons.crs)
-    # spatial join - polygons that contain points
-    tri_polygons = gpd.sjoin(polygons, gdf, how="inner", predicate="contains")
+    polygons = _read_polygons(shape_file)
+    # if gdf crs is not defined, assume these are manual lat/lon, and assign WSG4.
+    # Only the crs is needed here, so gdf isn't copied just to set it
+    points_crs = gdf.crs or CRS.from_epsg(4326)
+    # spatial join - polygons that contain points. Query a shapely STRtree of the
+    # points directly rather than going through gpd.sjoin's pandas machinery.
+    # The tree stays on the point side: querying the polygon sindex with every
+    # point ("within") runs one exact polygon test per point and is far slower
+    # for the few-polygons/many-points layers this is used with.
+    points = np.asarray(gdf.geometry.values)
+    if np.isin(shapely.get_type_id(points), (-1, 0)).all():
+        # only the point coordinates are needed, so reproject them to the crs of
+        # the polygons in one vectorized call rather than copying the whole frame
+        poly_idx, point_idx = _points_in_polygons(
+            points,
+            np.asarray(polygons.geometry.values),
+            points_crs,
+            polygons.crs,
+            # cached layers come with their index already built
+            polygons.sindex if polygons.has_sindex else None,
+        )
+    else:
+        # set crs of point gdf to match the polygons
+        points = gdf.geometry.set_crs(points_crs).to_crs(polygons.crs)
+        tree = shapely.STRtree(np.asarray(points.values))
+        poly_idx, point_idx = tree.query(
+            np.asarray(polygons.geometry.values), predicate="contains"
+        )
+    points = gdf.drop(columns=gdf.geometry.name).iloc[point_idx]
+    # same column naming as gpd.sjoin
+    shared_columns = set(polygons.columns) & set(points.columns)
+    tri_polygons = polygons.rename(
+        columns={col: f"{col}_left" for col in shared_columns}
+    ).iloc[poly_idx]
+    points = points.rename(columns={col: f"{col}_right" for col in shared_columns})
+    tri_polygons = tri_polygons.assign(
+        index_right=points.index.to_numpy(),
+        **{col: points[col].array for col in points.columns},
+    )
     return tri_polygons
 
 
+def _weak_geocode(geolocator_obj: Nominatim):
+    # geolocator_obj.geocode without a strong reference to the geolocator, so that
+    # the RateLimiter wrapping it doesn't keep its _RATE_LIMITERS key alive
+    geocode_method = weakref.WeakMethod(geolocator_obj.geocode)
+
+    def geocode(*args, **kwargs):
+        return geocode_method()(*args, **kwargs)
+
+    return geocode
+
+
+def _rate_limited_geocode(geolocator_obj: Nominatim) -> RateLimiter:
+    # one RateLimiter per geolocator, so the delay between requests is kept across
+    # calls and threads. Entries go away with the geolocator
+    with _RATE_LIMITERS_LOCK:
+        try:
+            return _RATE_LIMITERS[geolocator_obj]
+        except KeyError:
+            geocode = RateLimiter(
+                _weak_geocode(geolocator_obj),
+                min_delay_seconds=1,
+                max_retries=0,
+                swallow_exceptions=False,
+            )
+            _RATE_LIMITERS[geolocator_obj] = geocode
+            return geocode
+
+
 def geocode_from_raw_address(
     address_string: str, geolocator_obj: Nominatim, attempt=1, num_retries: int = 5
 ):
@@ -128,79 +377,400 @@ def geocode_from_raw_address(
     Returns:
         Geocoder response. In the event no response can be reached, returns NaN
     """
-    geocode = RateLimiter(
-        geolocator_obj.geocode,
-        min_delay_seconds=1,
-        max_retries=0,
-        swallow_exceptions=False,
+    geocode = _rate_limited_geocode(geolocator_obj)
+    for attempt in range(attempt, num_retries + 2):
+        try:
+            location = geocode(address_string)
+            return (location.latitude, location.longitude)
+        except GeocoderUnavailable:
+            if attempt <= num_retries:
+                # exponential backoff from 0.5s before trying again
+                time.sleep(backoff_delay(attempt - 1, base_delay=0.5))
+        except AttributeError:
+            # addresses not found returned as none
+            return None
+        except Exception as exec:
+            return np.nan
+    warnings.warn(f"!! RAN OUT OF RETRIES: {address_string}", RetriesExhaustedWarning)
+    return None
+
+
+def _normalize_address(address_string: str) -> str:
+    # upper case, single spaces, and no punctuation other than "#" and "-", which
+    # tell apart units and house numbers such as "1-A" and "1A" or "#2" and "2"
+    address_string = re.sub(r"[^\w\s#-]", "", address_string.upper())
+    return re.sub(r"\s+", " ", address_string).strip()
+
+
+def _geocache_connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(GEOCODE_CACHE), exist_ok=True)
+    connection = sqlite3.connect(GEOCODE_CACHE)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS geocache"
+        "(addr TEXT PRIMARY KEY, lat REAL, lon REAL, ts INTEGER)"
     )
+    return connection
+
+
+def _host_semaphore(geolocator_obj: Nominatim):
+    # Nominatim's usage policy allows no parallel requests, so requests to the same
+    # Nominatim host are made one at a time. Other geocoders are not limited here
+    if not isinstance(geolocator_obj, Nominatim):
+        return nullcontext()
+    with _HOST_SEMAPHORES_LOCK:
+        return _HOST_SEMAPHORES.setdefault(
+            geolocator_obj.domain, threading.Semaphore(1)
+        )
+
+
+def _geocache_get(address_key: str) -> Optional[Tuple[float, float]]:
     try:
-        location = geocode(address_string)
-        return (location.latitude, location.longitude)
-    except GeocoderUnavailable:
-        if attempt > num_retries:
-            warnings.warn(
-                f"!! RAN OUT OF RETRIES: {address_string}", RetriesExhaustedWarning
-            )
-        if attempt <= num_retries:
-            return geocode_from_raw_address(
-                address_string, geolocator_obj, attempt=attempt + 1
-            )
-        # raise
-    except AttributeError:
-        # addresses not found returned as none
+        with closing(_geocache_connect()) as connection:
+            return connection.execute(
+                "SELECT lat, lon FROM geocache WHERE addr = ?", (address_key,)
+            ).fetchone()
+    except (OSError, sqlite3.Error):
+        # the cache can't be created or read (e.g. read-only home), so don't use it
         return None
-    except Exception as exec:
-        return np.nan
 
 
-def geocoder_wrapper(address_components: Dict[str, str]):
+def _geocache_put(address_key: str, location: Tuple[float, float]):
+    try:
+        with closing(_geocache_connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO geocache VALUES (?, ?, ?, ?)",
+                (address_key, *location, int(time.time())),
+            )
+    except (OSError, sqlite3.Error):
+        pass
+
+
+def _geocode_cached(
+    address_string: str, geolocator_obj: Nominatim
+) -> Optional[Tuple[float, float]]:
+    # look the address up in the on-disk cache before going to the geocoder. Only
+    # found locations are stored, so failed or unavailable lookups are tried again
+    address_key = _normalize_address(address_string)
+    location = _geocache_get(address_key)
+    if location is not None:
+        return location
+    with _host_semaphore(geolocator_obj):
+        location = geocode_from_raw_address(address_string, geolocator_obj)
+    if isinstance(location, tuple):
+        _geocache_put(address_key, location)
+    return location
+
+
+def _address_string(
+    address_components: Dict[str, str],
+    street: Optional[str] = None,
+    county: bool = True,
+) -> str:
+    # the one place address parts are joined into the string sent to the geocoder,
+    # which is also the geocache key, optionally with another street or no county
+    parts = [
+        address_components["STREET_ADDRESS"] if street is None else street,
+        address_components["CITY_NAME"],
+        address_components["COUNTY_NAME"] if county else None,
+        address_components["STATE_ABBR"],
+        address_components["ZIP_CODE"],
+    ]
+    return " ".join(f"{part}" for part in parts if part is not None)
+
+
+def geocoder_wrapper(
+    address_components: Dict[str, str], geolocator_obj: Optional[Nominatim] = None
+):
     """
     Convenience method to pass a set of address parts to `geocode_from_raw_address()`.
+    Locations found are cached on disk (geocache.sqlite in the tritoolkit cache
+    directory), so addresses seen before are not geocoded again.
 
     Args:
         address_components: Dictionary of address parts, such as street address, city, state, etc.
+        geolocator_obj: A geopy geolocator object. Defaults to a shared Nominatim geolocator.
 
     Returns:
         geopy location object
     """
-    geolocator = Nominatim(user_agent="tritoolkit")
-    address_string = " ".join(
-        [
-            address_components["STREET_ADDRESS"],
-            address_components["CITY_NAME"],
-            address_components["COUNTY_NAME"],
-            address_components["STATE_ABBR"],
-            address_components["ZIP_CODE"],
-        ]
-    )
-    location = geocode_from_raw_address(address_string, geolocator)
+    geolocator = geolocator_obj or _GEOLOCATOR
+    location = _geocode_cached(_address_string(address_components), geolocator)
     # if location not found, try without county
     if location is None:
-        address_string = " ".join(
-            [
-                address_components["STREET_ADDRESS"],
-                address_components["CITY_NAME"],
-                address_components["STATE_ABBR"],
-                address_components["ZIP_CODE"],
-            ]
+        location = _geocode_cached(
+            _address_string(address_components, county=False), geolocator
         )
-        location = geocode_from_raw_address(address_string, geolocator)
     # if location still not found, try without cardinal directions in street address
-    if location is None and address_components["STREET_ADDRESS"].strip()[-2:] in [
-        "NE",
-        "SE",
-        "NW",
-        "SW",
-    ]:
-        address_string = " ".join(
-            [
-                address_components["STREET_ADDRESS"][:-3],
-                address_components["CITY_NAME"],
-                address_components["COUNTY_NAME"],
-                address_components["STATE_ABBR"],
-                address_components["ZIP_CODE"],
-            ]
+    street = address_components["STREET_ADDRESS"]
+    if location is None and street.strip()[-2:] in _CARDINALS:
+        location = _geocode_cached(
+            _address_string(address_components, street=street[:-3]), geolocator
         )
-        location = geocode_from_raw_address(address_string, geolocator)
     return location
+
+
+def _address_strings(column: pd.Series) -> pd.Series:
+    # read_csv makes a numeric column float if any value is missing (e.g. zip
+    # codes), so write whole numbers without a trailing ".0". Missing parts are empty
+    if pd.api.types.is_float_dtype(column):
+        values = column.dropna()
+        if (values == np.floor(values)).all():
+            column = column.astype("Int64")
+    return column.astype("string").fillna("").astype(object)
+
+
+def geocode_dataframe(
+    df: pd.DataFrame,
+    address_cols: Optional[List[str]] = None,
+    workers: int = 4,
+    geolocator_obj: Optional[Nominatim] = None,
+) -> pd.DataFrame:
+    """
+    Geocode every row of a data frame with `geocoder_wrapper()`, using a pool of
+    threads. Requests to a Nominatim host are still made one at a time, so the threads
+    mostly overlap cache lookups; other geocoders are queried concurrently.
+
+    Args:
+        df: pandas data frame containing address fields
+        address_cols: Names of the street address, city, county, state and zip code
+                      columns, in that order. Defaults to ADDRESS_FIELDS.
+        workers: Number of threads. Defaults to 4.
+        geolocator_obj: A geopy geolocator object shared by all threads. Defaults to a
+                        shared Nominatim geolocator.
+
+    Returns:
+        A data frame with "lat" and "lon" columns and the same index as df. Addresses
+        that could not be geocoded are NaN.
+    """
+    address_cols = address_cols or ADDRESS_FIELDS
+    geolocator = geolocator_obj or _GEOLOCATOR
+    addresses = df[address_cols].apply(_address_strings)
+    rows = [
+        dict(zip(ADDRESS_FIELDS, address))
+        for address in addresses.itertuples(index=False, name=None)
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        locations = list(
+            executor.map(lambda row: geocoder_wrapper(row, geolocator), rows)
+        )
+    return pd.DataFrame(
+        [
+            location if isinstance(location, tuple) else (np.nan, np.nan)
+            for location in locations
+        ],
+        columns=["lat", "lon"],
+        index=df.index,
+        dtype="float64",
+    )
+
+
+def geocode_unique(
+    addr_df: pd.DataFrame,
+    address_cols: Optional[List[str]] = None,
+    workers: int = 4,
+    geolocator_obj: Optional[Nominatim] = None,
+) -> pd.DataFrame:
+    """
+    Like `geocode_dataframe()`, but geocodes each distinct address only once. Useful
+    for multi-year TRI data, where the same facilities appear every year.
+
+    Args:
+        addr_df: pandas data frame containing address fields
+        address_cols: Names of the street address, city, county, state and zip code
+                      columns, in that order. Defaults to ADDRESS_FIELDS.
+        workers: Number of threads. Defaults to 4.
+        geolocator_obj: A geopy geolocator object shared by all threads. Defaults to a
+                        shared Nominatim geolocator.
+
+    Returns:
+        A data frame with "lat" and "lon" columns and the same index as addr_df.
+    """
+    address_cols = address_cols or ADDRESS_FIELDS
+    addresses = addr_df[address_cols]
+    unique = addresses.drop_duplicates()
+    locations = geocode_dataframe(unique, address_cols, workers, geolocator_obj)
+    located = addresses.merge(
+        pd.concat([unique, locations], axis=1), on=address_cols, how="left"
+    )
+    return located[["lat", "lon"]].set_axis(addr_df.index)
+
+
+def _arcgis_batch(
+    session: requests.Session,
+    addresses: List[Dict[str, str]],
+    offset: int,
+    token: str,
+    num_retries: int = 5,
+) -> Dict[int, Tuple[float, float]]:
+    # POST one batch to the geocodeAddresses endpoint. Records are keyed by their
+    # position in the full input so the results can be put back in order
+    records = [
+        {
+            "attributes": {
+                "OBJECTID": offset + i,
+                "Address": address["STREET_ADDRESS"],
+                "City": address["CITY_NAME"],
+                "Region": address["STATE_ABBR"],
+                "Postal": address["ZIP_CODE"],
+            }
+        }
+        for i, address in enumerate(addresses)
+    ]
+    data = {
+        "addresses": json.dumps({"records": records}),
+        "f": "json",
+        "outSR": 4326,
+        "token": token,
+    }
+    for attempt in range(num_retries + 1):
+        try:
+            response = session.post(ARCGIS_BATCH_URL, data=data)
+            if not is_transient_status(response.status_code):
+                break
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == num_retries:
+                raise
+        if attempt < num_retries:
+            time.sleep(backoff_delay(attempt))
+    response.raise_for_status()
+    payload = response.json()
+    # the service reports errors such as an invalid token with HTTP 200
+    if "error" in payload:
+        error = payload["error"]
+        raise GeocoderServiceError(
+            f"ArcGIS batch geocoding failed ({error.get('code')}): "
+            f"{error.get('message')}"
+        )
+    results = {}
+    for location in payload.get("locations", []):
+        point = location.get("location")
+        if location.get("score") and point:
+            results[location["attributes"]["ResultID"]] = (point["y"], point["x"])
+    return results
+
+
+async def _nominatim_geocode_async(
+    session: aiohttp.ClientSession,
+    semaphore: asyncio.Semaphore,
+    address_string: str,
+    min_delay_seconds: float,
+    num_retries: int = 5,
+) -> Optional[Tuple[float, float]]:
+    # the semaphore serializes the requests to keep to Nominatim's usage policy,
+    # while the shared session keeps the connection open between them. Backing off
+    # while holding it pauses the whole batch, which is what a 429 asks for
+    async with semaphore:
+        for attempt in range(num_retries + 1):
+            started = time.monotonic()
+            try:
+                async with session.get(
+                    NOMINATIM_URL,
+                    params={"q": address_string, "format": "json", "limit": 1},
+                ) as response:
+                    response.raise_for_status()
+                    matches = await response.json()
+                break
+            except aiohttp.ClientResponseError as err:
+                if not is_transient_status(err.status):
+                    return None
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            finally:
+                await asyncio.sleep(
+                    max(0, min_delay_seconds - (time.monotonic() - started))
+                )
+            if attempt < num_retries:
+                await asyncio.sleep(backoff_delay(attempt, base_delay=0.5))
+        else:
+            warnings.warn(
+                f"!! RAN OUT OF RETRIES: {address_string}", RetriesExhaustedWarning
+            )
+            return None
+    if not matches:
+        return None
+    return (float(matches[0]["lat"]), float(matches[0]["lon"]))
+
+
+async def _nominatim_batch_async(
+    address_strings: List[str], user_agent: str, min_delay_seconds: float
+) -> List[Optional[Tuple[float, float]]]:
+    semaphore = asyncio.Semaphore(1)
+    async with aiohttp.ClientSession(
+        headers={"User-Agent": user_agent}, trust_env=True
+    ) as session:
+        return await asyncio.gather(
+            *[
+                _nominatim_geocode_async(
+                    session, semaphore, address_string, min_delay_seconds
+                )
+                for address_string in address_strings
+            ]
+        )
+
+
+def geocode_batch(
+    addresses: List[Dict[str, str]],
+    arcgis_token: Optional[str] = None,
+    batch_size: int = 1000,
+    user_agent: str = "tritoolkit",
+    min_delay_seconds: float = 1,
+) -> pd.DataFrame:
+    """
+    Geocode many addresses at once. With an ArcGIS token, addresses are sent to the
+    ArcGIS World Geocoder in batches of up to `batch_size` per request. Otherwise they
+    are geocoded with Nominatim one after the other over a single connection, at most
+    one request every `min_delay_seconds`. Transient errors are retried with backoff.
+    Like `geocoder_wrapper()`, locations found are cached on disk and cached
+    addresses are not geocoded again.
+
+    Args:
+        addresses: List of address dictionaries with the same keys as for
+                   `geocoder_wrapper()`
+        arcgis_token: ArcGIS token allowed to use the batch geocoding service
+        batch_size: Number of addresses per ArcGIS request. Defaults to 1000, the
+                    service maximum.
+        user_agent: User agent sent to Nominatim
+        min_delay_seconds: Minimum time between Nominatim requests. Defaults to 1.
+
+    Returns:
+        A data frame with "lat" and "lon" columns in the same order as addresses.
+        Addresses that could not be geocoded are NaN.
+    """
+    # addresses are cached under the same key as in geocoder_wrapper(), and only
+    # the ones not found in the cache are sent to the geocoder
+    address_keys = [
+        _normalize_address(_address_string(address)) for address in addresses
+    ]
+    locations = [_geocache_get(address_key) for address_key in address_keys]
+    missing = [i for i, location in enumerate(locations) if location is None]
+    found: List[Optional[Tuple[float, float]]] = []
+    if arcgis_token is not None:
+        results: Dict[int, Tuple[float, float]] = {}
+        with requests.Session() as session:
+            for offset in range(0, len(missing), batch_size):
+                results.update(
+                    _arcgis_batch(
+                        session,
+                        [addresses[i] for i in missing[offset : offset + batch_size]],
+                        offset,
+                        arcgis_token,
+                    )
+                )
+        found = [results.get(i) for i in range(len(missing))]
+    elif missing:
+        found = run_async(
+            _nominatim_batch_async(
+                [_address_string(addresses[i]) for i in missing],
+                user_agent,
+                min_delay_seconds,
+            )
+        )
+    for i, location in zip(missing, found):
+        if location is not None:
+            _geocache_put(address_keys[i], location)
+            locations[i] = location
+    return pd.DataFrame(
+        [location or (np.nan, np.nan) for location in locations],
+        columns=["lat", "lon"],
+        dtype="float64",
+    )
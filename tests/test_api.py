@@ -1,6 +1,7 @@
 import time
 import subprocess
 import pickle
+from datetime import date, timedelta
 from pathlib import Path
 
 import pandas as pd
@@ -8,13 +9,16 @@ import pandas as pd
 import pytest
 import vcr
 
-from tritoolkit import api
+from conftest import StubHandler
+from tritoolkit import _utils, api
 from tritoolkit.api import (
     TriApiClient,
     Table,
 )
+from tritoolkit.api import core
 from tritoolkit.api.exceptions import (
     TriApiException,
+    TransientTriApiException,
 )
 
 
@@ -38,33 +42,143 @@ def api_client(environment_variables, mock_api: str) -> TriApiClient:
     return client
 
 
+class StubTableHandler(StubHandler):
+    """
+    Serves a STUB table of `rows` rows, one column, for the COUNT and rows/a:b/CSV
+    urls. The first request for rows 0:9999 gets a 503, and the first for rows
+    10000:19999 a truncated body
+    """
+
+    rows = 25003
+    content_type = "text/csv; charset=utf-8"
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        first_request = self.server.requests[self.path] == 1
+        if self.path == "/STUB/COUNT/JSON":
+            return self._send(f'[{{"TOTALQUERYRESULTS": {self.rows}}}]'.encode())
+        row_min, row_max = map(int, self.path.split("/")[3].split(":"))
+        if first_request and row_min == 0:
+            return self._send(b"", 503)
+        body = "ROW_ID\n" + "".join(
+            f"{i}\n" for i in range(row_min, min(row_max, self.rows - 1) + 1)
+        )
+        if first_request and row_min == 10000:
+            # promise more than is sent, then hang up
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body) + 100))
+            self.end_headers()
+            self.wfile.write(body.encode())
+            self.close_connection = True
+            return
+        self._send(body.encode())
+
+
+@pytest.fixture
+def stub_api(stub_server):
+    return stub_server(StubTableHandler)
+
+
+def test_all_rows_async_retries(stub_api, monkeypatch):
+    """
+    Confirm that all_rows fetches every chunk concurrently, retrying chunks that
+    fail with a 503 or a truncated body
+    """
+    delays = []
+
+    async def no_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(core.asyncio, "sleep", no_sleep)
+    table = Table("STUB")
+    table.table_url = f"{stub_api.url}/STUB"
+    df = table.all_rows()
+    assert df["ROW_ID"].tolist() == list(range(StubTableHandler.rows))
+    assert stub_api.requests["/STUB/rows/0:9999/CSV/"] == 2
+    assert stub_api.requests["/STUB/rows/10000:19999/CSV/"] == 2
+    assert stub_api.requests["/STUB/rows/20000:25003/CSV/"] == 1
+    assert len(delays) == 2
+
+
+def test_client_session_pools_connections(tri_client: TriApiClient):
+    """
+    Confirm that the default session reuses pooled keep-alive connections
+    """
+    adapter = tri_client.session.get_adapter(tri_client.base_url)
+    assert adapter._pool_maxsize == 64
+    assert tri_client.session.headers["Connection"] == "keep-alive"
+
+
+@pytest.mark.default_cassette("test_table_filter_on_single_value.yaml")
 @pytest.mark.vcr
-def test_table_filter_on_single_value(fixtures_path: Path):
+@pytest.mark.parametrize(
+    "table, filters, fixture_name",
+    [
+        # one single value
+        (
+            "TRI_CHEM_INFO",
+            {"CHEM_NAME": "Dioxin%20and%20dioxin%2Dlike%20compounds"},
+            "chem_info_dlc.pkl",
+        ),
+        # multiple single values
+        (
+            "TRI_REPORTING_FORM",
+            {"TRI_CHEM_ID": "N150", "REPORTING_YEAR": "2021"},
+            "reporting_forms_dlc_2021.pkl",
+        ),
+    ],
+    indirect=["table"],
+)
+def test_table_filter_on_single_value(
+    table: Table, filters: dict, fixture_name: str, fixtures_path: Path
+):
     """
     Confirm that table is filtered on single value
     """
-    # one single value
-    chem_str = "Dioxin%20and%20dioxin%2Dlike%20compounds"
-    chem_info_table = Table("TRI_CHEM_INFO").filter(filters={"CHEM_NAME": chem_str})
+    filtered_table = table.filter(filters=filters)
 
     # unpickle the test df
+    with open(fixtures_path / fixture_name, "rb") as infile:
+        filtered_table_pkl = pickle.load(infile)
+
+    assert filtered_table_pkl.equals(filtered_table)
+
+
+@pytest.mark.default_cassette("test_table_filter_on_single_value.yaml")
+@pytest.mark.vcr
+def test_table_filter_pyarrow_engine(fixtures_path: Path):
+    """
+    Confirm that the pyarrow csv engine parses the same rows
+    """
+    pytest.importorskip("pyarrow")
+    chem_str = "Dioxin%20and%20dioxin%2Dlike%20compounds"
+    chem_info_table = Table("TRI_CHEM_INFO", csv_engine="pyarrow").filter(
+        filters={"CHEM_NAME": chem_str}
+    )
+
     with open(fixtures_path / "chem_info_dlc.pkl", "rb") as infile:
         chem_info_pkl = pickle.load(infile)
 
-    assert chem_info_pkl.equals(chem_info_table)
-
-    reporting_forms = Table("TRI_REPORTING_FORM").filter(
-        filters={"TRI_CHEM_ID": "N150", "REPORTING_YEAR": "2021"}
+    # columns come back arrow-backed
+    assert all(isinstance(dtype, pd.ArrowDtype) for dtype in chem_info_table.dtypes)
+    pd.testing.assert_frame_equal(
+        chem_info_pkl, chem_info_table.astype(chem_info_pkl.dtypes)
     )
-    # multiple single values# unpickle the test df
-    with open(fixtures_path / "reporting_forms_dlc_2021.pkl", "rb") as infile:
-        reporting_forms_pkl = pickle.load(infile)
 
-    assert reporting_forms_pkl.equals(reporting_forms)
+
+def test_pyarrow_engine_requires_pyarrow(monkeypatch):
+    """
+    Confirm that asking for the pyarrow engine without pyarrow fails loudly
+    """
+    monkeypatch.setattr(core, "pa", None)
+    with pytest.raises(ImportError):
+        Table("TRI_FACILITY", csv_engine="pyarrow")
 
 
+@pytest.mark.default_cassette("test_table_filter_on_multiple_values.yaml")
 @pytest.mark.vcr
-def test_table_filter_on_multiple_values(fixtures_path: Path):
+@pytest.mark.parametrize("table", ["TRI_FACILITY"], indirect=True)
+def test_table_filter_on_multiple_values(table: Table, fixtures_path: Path):
     """
     Confirm that table is filtered on multiple values
     """
@@ -72,12 +186,118 @@ def test_table_filter_on_multiple_values(fixtures_path: Path):
     with open(fixtures_path / "facilities_list.pkl", "rb") as infile:
         facilities_list = pickle.load(infile)
 
-    dioxin_facilities = Table("TRI_FACILITY").filter(
-        filters={"TRI_FACILITY_ID": facilities_list}
-    )
+    dioxin_facilities = table.filter(filters={"TRI_FACILITY_ID": facilities_list})
 
     # unpickle the test df
     with open(fixtures_path / "facilities_dlc_2017_2021.pkl", "rb") as infile:
         dioxin_facilities_pkl = pickle.load(infile)
 
     assert dioxin_facilities_pkl.equals(dioxin_facilities)
+
+
+def test_segments():
+    """
+    Confirm that table rows are split into chunks of at most 10000 rows
+    """
+    table = Table("TRI_FACILITY")
+    assert table._segments(0) == [(0, 0)]
+    assert table._segments(9999) == [(0, 9999)]
+    assert table._segments(10000) == [(0, 9999), (10000, 10000)]
+    assert table._segments(25003) == [(0, 9999), (10000, 19999), (20000, 25003)]
+
+
+def test_count_cache_falls_back_without_cache_dir(tmp_path: Path, monkeypatch):
+    """
+    Confirm that an unusable cache directory turns off the row count cache
+    instead of failing
+    """
+    not_a_dir = tmp_path / "cache"
+    not_a_dir.write_text("")
+    monkeypatch.setattr(core, "CACHE_DIR", str(not_a_dir))
+    monkeypatch.setattr(core, "_memory", None)
+    assert core._get_memory().location is None
+
+
+def test_count_cache_refresh(stub_api, monkeypatch):
+    """
+    Confirm that the cached row count is replaced when a table is created with
+    use_cache=False, and expires the next day
+    """
+
+    def stub_table(**kwargs) -> Table:
+        table = Table("STUB", **kwargs)
+        table.table_url = f"{stub_api.url}/STUB"
+        return table
+
+    assert stub_table().rows == 25003
+    monkeypatch.setattr(StubTableHandler, "rows", 30000)
+    assert stub_table().rows == 25003
+    assert stub_api.requests["/STUB/COUNT/JSON"] == 1
+    assert stub_table(use_cache=False).rows == 30000
+    assert stub_table().rows == 30000
+    assert stub_api.requests["/STUB/COUNT/JSON"] == 2
+
+    class Tomorrow(date):
+        @classmethod
+        def today(cls):
+            return date.today() + timedelta(days=1)
+
+    monkeypatch.setattr(StubTableHandler, "rows", 35000)
+    monkeypatch.setattr(core, "date", Tomorrow)
+    assert stub_table().rows == 35000
+
+
+def test_fix_filter_strings():
+    """
+    Confirm that filter values are url-encoded and operators get their own segment
+    """
+    table = Table("TRI_FACILITY")
+    assert table._fix_filter_strings("N150") == "N150"
+    assert (
+        table._fix_filter_strings("Dioxin and dioxin-like compounds")
+        == "Dioxin%20and%20dioxin%2Dlike%20compounds"
+    )
+    # already encoded values are left alone
+    assert (
+        table._fix_filter_strings("Dioxin%20and%20dioxin%2Dlike%20compounds")
+        == "Dioxin%20and%20dioxin%2Dlike%20compounds"
+    )
+    assert table._fix_filter_strings("A/B & C") == "A%2FB%20%26%20C"
+    # a "%" that doesn't start an escape is encoded itself
+    assert table._fix_filter_strings("50%") == "50%25"
+    assert table._fix_filter_strings("100% A-B") == "100%25%20A%2DB"
+    assert table._fix_filter_strings("%ZZ") == "%25ZZ"
+    assert table._fix_filter_strings(">2015") == ">/2015"
+    assert table._fix_filter_strings("<2015") == "</2015"
+    assert table._fix_filter_strings("!=MN") == "!=/MN"
+
+
+def test_retry_on_transient_error_backs_off(monkeypatch):
+    """
+    Confirm that transient errors are retried with growing, capped delays
+    """
+    delays = []
+    monkeypatch.setattr(core.time, "sleep", delays.append)
+
+    class FlakyClient(TriApiClient):
+        calls = 0
+
+        @core.retry_on_transient_error
+        def flaky(self):
+            self.calls += 1
+            if self.calls < 4:
+                raise TransientTriApiException("try again")
+            return "ok"
+
+    client = FlakyClient(num_retries=4)
+    assert client.flaky() == "ok"
+    assert client.calls == 4
+    assert len(delays) == 3
+    for attempt, delay in enumerate(delays):
+        assert 2**attempt <= delay <= 1.5 * 2**attempt
+
+    # the final attempt's exception is raised to the caller
+    client = FlakyClient(num_retries=2)
+    with pytest.raises(TransientTriApiException):
+        client.flaky()
+    assert _utils.backoff_delay(10) <= 30.0 * 1.5
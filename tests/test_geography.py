@@ -1,10 +1,19 @@
 import pytest
+import gc
+import json
 import pickle
+import weakref
 from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
 
+import geopandas as gpd
 import numpy as np
+import pandas as pd
+import shapely
+from geopy.exc import GeocoderServiceError
 from geopy.geocoders import Nominatim
 
+from conftest import StubHandler
 from tritoolkit import geography
 
 
@@ -21,6 +30,50 @@ def test_dms_to_dd():
     assert geography.dms_to_dd(-1005305.0) == -100.88472222222222
 
 
+def test_dms_to_dd_series():
+    """test the vectorized conversion against the scalar one"""
+    dms_values = pd.Series(
+        [324528.0, np.nan, -324528.0, 1005305.0, -1005305.0, 5.0, -1000000.0],
+        name="FAC_LATITUDE",
+    )
+    dd_values = geography.dms_to_dd_series(dms_values)
+    assert dd_values.name == "FAC_LATITUDE"
+    assert dd_values.equals(dms_values.apply(geography.dms_to_dd))
+    # arrays and series passed to dms_to_dd take the vectorized path
+    assert dd_values.equals(geography.dms_to_dd(dms_values))
+    np.testing.assert_array_equal(
+        geography.dms_to_dd(dms_values.to_numpy()), dd_values.to_numpy()
+    )
+
+
+def test_dms_array_to_dd_without_numba(monkeypatch):
+    """the numba and pure NumPy conversions agree, out of range parts included"""
+    # negatives, zero, missing, and minutes or seconds of 60 and over, which are
+    # carried over rather than rejected
+    dms_values = np.array(
+        [
+            324528.0,
+            -324528.0,
+            0.0,
+            np.nan,
+            5.0,
+            324575.0,
+            327500.0,
+            -329999.0,
+            1005305.0,
+            -1000000.0,
+            1795959.0,
+        ]
+    )
+    dd_values = geography._dms_array_to_dd(dms_values)
+    monkeypatch.setattr(geography, "numba", None)
+    np.testing.assert_array_equal(geography._dms_array_to_dd(dms_values), dd_values)
+    np.testing.assert_array_equal(
+        dd_values, [geography.dms_to_dd(dms_value) for dms_value in dms_values]
+    )
+    assert dd_values[5] == 32 + 45 / 60 + 75 / 3600
+
+
 def test_to_gopandas_df(fixtures_path: Path):
     # unpickle the test df
     with open(fixtures_path / "dlc_facilities.pkl", "rb") as infile:
@@ -59,6 +112,18 @@ def test_geocode_from_raw_address():
     assert (lat, lon) == (34.1941851, -79.586317)
 
 
+def test_rate_limiters_released(monkeypatch):
+    """a geolocator's rate limiter is shared between calls and released with it"""
+    monkeypatch.setattr(geography, "_RATE_LIMITERS", weakref.WeakKeyDictionary())
+    geolocator = Nominatim(user_agent="test_geocoder")
+    geocode = geography._rate_limited_geocode(geolocator)
+    assert geography._rate_limited_geocode(geolocator) is geocode
+    assert len(geography._RATE_LIMITERS) == 1
+    del geolocator, geocode
+    gc.collect()
+    assert len(geography._RATE_LIMITERS) == 0
+
+
 @pytest.mark.vcr
 def test_geocoder_wrapper():
     lat, lon = geography.geocoder_wrapper(
@@ -82,3 +147,267 @@ def test_geocoder_wrapper():
         }
     )
     assert (lat, lon) == (34.1941851, -79.586317)
+
+
+def test_geocode_cache(fake_geocoder):
+    """found locations are cached by normalized address, misses are not"""
+    fake_geocoder.locations["7320 MILL RD FLORENCE SC 29506"] = (34.1941851, -79.586317)
+    assert geography._geocode_cached("7320 MILL RD FLORENCE SC 29506", None) == (
+        34.1941851,
+        -79.586317,
+    )
+    assert geography._geocode_cached("7320 Mill Rd.,  Florence SC 29506", None) == (
+        34.1941851,
+        -79.586317,
+    )
+    assert geography._geocode_cached("NOWHERE", None) is None
+    assert geography._geocode_cached("NOWHERE", None) is None
+    assert fake_geocoder.calls == [
+        "7320 MILL RD FLORENCE SC 29506",
+        "NOWHERE",
+        "NOWHERE",
+    ]
+
+
+def test_geocode_cache_distinct_addresses(fake_geocoder):
+    """addresses that differ by "#" or "-" don't share a cache entry"""
+    fake_geocoder.locations["1-A MAIN ST"] = (1.0, 2.0)
+    fake_geocoder.locations["1A MAIN ST"] = (3.0, 4.0)
+    fake_geocoder.locations["1 MAIN ST #2"] = (5.0, 6.0)
+    fake_geocoder.locations["1 MAIN ST 2"] = (7.0, 8.0)
+    for _ in range(2):
+        assert geography._geocode_cached("1-A MAIN ST", None) == (1.0, 2.0)
+        assert geography._geocode_cached("1A MAIN ST", None) == (3.0, 4.0)
+        assert geography._geocode_cached("1 MAIN ST #2", None) == (5.0, 6.0)
+        assert geography._geocode_cached("1 MAIN ST 2", None) == (7.0, 8.0)
+    assert len(fake_geocoder.calls) == 4
+
+
+def test_geocode_cache_unwritable(cache_dir: Path, fake_geocoder):
+    """an unusable cache directory turns the geocode cache off instead of failing"""
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
+    cache_dir.write_text("")
+    fake_geocoder.locations["7320 MILL RD FLORENCE SC 29506"] = (34.1941851, -79.586317)
+    for _ in range(2):
+        assert geography._geocode_cached("7320 MILL RD FLORENCE SC 29506", None) == (
+            34.1941851,
+            -79.586317,
+        )
+    assert len(fake_geocoder.calls) == 2
+
+
+def test_geocode_dataframe(fake_geocoder):
+    fake_geocoder.locations["7320 MILL RD FLORENCE FLORENCE SC 29506"] = (
+        34.1941851,
+        -79.586317,
+    )
+    addresses = pd.DataFrame(
+        {
+            "STREET_ADDRESS": ["7320 MILL RD", "1 NOWHERE ST"],
+            "CITY_NAME": ["FLORENCE", "NOWHERE"],
+            "COUNTY_NAME": ["FLORENCE", "NOWHERE"],
+            "STATE_ABBR": ["SC", "SC"],
+            "ZIP_CODE": [29506, np.nan],
+        },
+        index=[10, 20],
+    )
+    locations = geography.geocode_dataframe(addresses, geolocator_obj=object())
+    expected = pd.DataFrame(
+        {"lat": [34.1941851, np.nan], "lon": [-79.586317, np.nan]}, index=[10, 20]
+    )
+    pd.testing.assert_frame_equal(locations, expected)
+    # whole-number zip codes are written without ".0", missing ones are left out
+    assert sorted(fake_geocoder.calls) == [
+        "1 NOWHERE ST NOWHERE NOWHERE SC ",
+        "1 NOWHERE ST NOWHERE SC ",
+        "7320 MILL RD FLORENCE FLORENCE SC 29506",
+    ]
+
+
+def test_points_in_polygons():
+    polygons = gpd.GeoDataFrame(
+        geometry=[shapely.box(0, 0, 2, 2), shapely.box(1, 1, 3, 3)], crs=3857
+    )
+    points = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy([0.5, 1.5, 2.5, 5, 2], [0.5, 1.5, 2.5, 5, 0]),
+        crs=3857,
+    )
+    poly_idx, point_idx = geography.points_in_polygons(points, polygons)
+    expected = shapely.STRtree(points.geometry.values).query(
+        polygons.geometry.values, predicate="contains"
+    )
+    np.testing.assert_array_equal(np.vstack([poly_idx, point_idx]), expected)
+    assert sorted(zip(poly_idx, point_idx)) == [(0, 0), (0, 1), (1, 1), (1, 2)]
+
+
+def test_geocode_unique(fake_geocoder):
+    fake_geocoder.locations["7320 MILL RD FLORENCE FLORENCE SC 29506"] = (
+        34.1941851,
+        -79.586317,
+    )
+    mill = ["7320 MILL RD", "FLORENCE", "FLORENCE", "SC", "29506"]
+    nowhere = ["1 NOWHERE ST", "NOWHERE", "NOWHERE", "SC", "29506"]
+    addresses = pd.DataFrame(
+        [mill, nowhere, mill, mill],
+        columns=geography.ADDRESS_FIELDS,
+        index=[3, 2, 1, 0],
+    )
+    locations = geography.geocode_unique(addresses, geolocator_obj=object())
+    expected = pd.DataFrame(
+        {
+            "lat": [34.1941851, np.nan, 34.1941851, 34.1941851],
+            "lon": [-79.586317, np.nan, -79.586317, -79.586317],
+        },
+        index=[3, 2, 1, 0],
+    )
+    pd.testing.assert_frame_equal(locations, expected)
+    # one lookup for the found address, two (with and without county) for the other
+    assert sorted(fake_geocoder.calls) == [
+        "1 NOWHERE ST NOWHERE NOWHERE SC 29506",
+        "1 NOWHERE ST NOWHERE SC 29506",
+        "7320 MILL RD FLORENCE FLORENCE SC 29506",
+    ]
+
+
+class StubGeocoderHandler(StubHandler):
+    """
+    Serves Nominatim searches from `locations` and ArcGIS geocodeAddresses batches.
+    Nominatim searches for "BUSY" get a 429 and those for "DOWN" a 503 on the first
+    request. ArcGIS batches sent with the token "busy" get a 503 on the first request,
+    and those sent with the token "expired" an HTTP 200 error
+    """
+
+    locations = {
+        "7320 MILL RD FLORENCE FLORENCE SC 29506": (34.1941851, -79.586317),
+        "BUSY": (1.0, 2.0),
+        "DOWN": (3.0, 4.0),
+    }
+
+    def do_GET(self):
+        address_string = parse_qs(urlsplit(self.path).query)["q"][0]
+        self.server.requests[address_string] += 1
+        first_request = self.server.requests[address_string] == 1
+        if first_request and address_string in ("BUSY", "DOWN"):
+            return self._send(b"", 429 if address_string == "BUSY" else 503)
+        if address_string == "MISSING":
+            return self._send(b"", 404)
+        matches = []
+        if address_string in self.locations:
+            lat, lon = self.locations[address_string]
+            matches.append({"lat": str(lat), "lon": str(lon)})
+        self._send(json.dumps(matches).encode())
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        token = form["token"][0]
+        self.server.requests[f"arcgis {token}"] += 1
+        if token == "busy" and self.server.requests["arcgis busy"] == 1:
+            return self._send(b"", 503)
+        if token == "expired":
+            payload = {"error": {"code": 498, "message": "Invalid Token"}}
+            return self._send(json.dumps(payload).encode())
+        locations = []
+        for record in json.loads(form["addresses"][0])["records"]:
+            attributes = record["attributes"]
+            address_string = (
+                f"{attributes['Address']} {attributes['City']} "
+                f"{attributes['City']} {attributes['Region']} {attributes['Postal']}"
+            )
+            self.server.requests[address_string] += 1
+            lat, lon = self.locations.get(address_string, (None, None))
+            locations.append(
+                {
+                    "attributes": {"ResultID": attributes["OBJECTID"]},
+                    "score": 100 if lat is not None else 0,
+                    "location": {"x": lon, "y": lat} if lat is not None else None,
+                }
+            )
+        self._send(json.dumps({"locations": locations}).encode())
+
+
+@pytest.fixture
+def stub_geocoder(stub_server, monkeypatch):
+    server = stub_server(StubGeocoderHandler)
+    monkeypatch.setattr(geography, "NOMINATIM_URL", f"{server.url}/search")
+    monkeypatch.setattr(geography, "ARCGIS_BATCH_URL", f"{server.url}/geocodeAddresses")
+    monkeypatch.setattr(geography, "backoff_delay", lambda *args, **kwargs: 0)
+    return server
+
+
+def _batch_address(street_address: str) -> dict:
+    return {
+        "STREET_ADDRESS": street_address,
+        "CITY_NAME": "FLORENCE",
+        "COUNTY_NAME": "FLORENCE",
+        "STATE_ABBR": "SC",
+        "ZIP_CODE": "29506",
+    }
+
+
+MILL = "7320 MILL RD FLORENCE FLORENCE SC 29506"
+NOWHERE = "1 NOWHERE ST FLORENCE FLORENCE SC 29506"
+
+
+def test_geocode_batch_nominatim(stub_geocoder):
+    """
+    rate limited and failed searches are retried, misses and 4xx are NaN, and found
+    locations are cached
+    """
+    addresses = [_batch_address("7320 MILL RD"), _batch_address("1 NOWHERE ST")]
+    expected = pd.DataFrame({"lat": [34.1941851, np.nan], "lon": [-79.586317, np.nan]})
+    for _ in range(2):
+        locations = geography.geocode_batch(addresses, min_delay_seconds=0)
+        pd.testing.assert_frame_equal(locations, expected)
+    assert stub_geocoder.requests[MILL] == 1
+    assert stub_geocoder.requests[NOWHERE] == 2
+
+    results = geography.run_async(
+        geography._nominatim_batch_async(
+            ["BUSY", "DOWN", "MISSING"], "tritoolkit", min_delay_seconds=0
+        )
+    )
+    assert results == [(1.0, 2.0), (3.0, 4.0), None]
+    assert stub_geocoder.requests["BUSY"] == 2
+    assert stub_geocoder.requests["DOWN"] == 2
+    assert stub_geocoder.requests["MISSING"] == 1
+
+
+def test_geocode_batch_arcgis(stub_geocoder):
+    """
+    addresses are sent in batches and put back in order, failed batches are retried
+    and cached addresses are not sent again
+    """
+    addresses = [
+        _batch_address("1 NOWHERE ST"),
+        _batch_address("7320 MILL RD"),
+        _batch_address("7320 MILL RD"),
+    ]
+    expected = pd.DataFrame(
+        {
+            "lat": [np.nan, 34.1941851, 34.1941851],
+            "lon": [np.nan, -79.586317, -79.586317],
+        }
+    )
+    locations = geography.geocode_batch(addresses, arcgis_token="token", batch_size=2)
+    pd.testing.assert_frame_equal(locations, expected)
+    assert stub_geocoder.requests["arcgis token"] == 2
+
+    locations = geography.geocode_batch(addresses, arcgis_token="busy")
+    pd.testing.assert_frame_equal(locations, expected)
+    assert stub_geocoder.requests["arcgis busy"] == 2
+    assert stub_geocoder.requests[MILL] == 2
+    assert stub_geocoder.requests[NOWHERE] == 2
+
+    with pytest.raises(GeocoderServiceError, match="Invalid Token"):
+        geography.geocode_batch(addresses, arcgis_token="expired")
+
+
+def test_geocode_batch_shares_geocache(fake_geocoder, stub_geocoder):
+    """addresses geocoded row by row are found in the cache by geocode_batch"""
+    fake_geocoder.locations[MILL] = (34.1941851, -79.586317)
+    address = _batch_address("7320 MILL RD")
+    assert geography.geocoder_wrapper(address, object()) == (34.1941851, -79.586317)
+    locations = geography.geocode_batch([address], min_delay_seconds=0)
+    expected = pd.DataFrame({"lat": [34.1941851], "lon": [-79.586317]})
+    pd.testing.assert_frame_equal(locations, expected)
+    assert stub_geocoder.requests[MILL] == 0